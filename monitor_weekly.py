@@ -1,12 +1,21 @@
-import os, json, time
-import requests
-import pandas as pd
-from datetime import datetime, timedelta
+import os, re, json, time, hashlib, uuid, glob
+import asyncio
+import aiohttp
+import ijson
+import jinja2
+import httpx
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pyarrow.dataset as ds
+from datetime import datetime, timedelta, timezone
 from zoneinfo import ZoneInfo
+from dataclasses import dataclass
+from types import MappingProxyType
+from typing import Final
 import smtplib
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
-from google import genai
+from diskcache import Cache
 
 # -----------------------------
 # ENV / CONFIG
@@ -27,21 +36,65 @@ LAB_CONTEXT = os.environ.get("LAB_CONTEXT", "").strip()
 # Gemini
 GEMINI_API_KEY = os.environ.get("GEMINI_API_KEY", "").strip()
 GEMINI_MODEL = os.environ.get("GEMINI_MODEL", "").strip() or "gemini-2.0-flash"
+GEMINI_API_BASE = "https://generativelanguage.googleapis.com/v1beta"
+GEMINI_EMBED_MODEL = os.environ.get("GEMINI_EMBED_MODEL", "").strip() or "gemini-embedding-001"
+# Regenerate the Gemini analysis even when no new papers arrived since the last report
+FORCE_REGEN = os.environ.get("FORCE_REGEN", "").strip().lower() in ("1", "true", "yes")
 
 # Scopus API
 SCOPUS_URL = "https://api.elsevier.com/content/search/scopus"
-SCOPUS_HEAD = {"X-ELS-APIKey": SCOPUS_API_KEY, "Accept": "application/json"}
+SCOPUS_HEAD: Final = MappingProxyType({"X-ELS-APIKey": SCOPUS_API_KEY, "Accept": "application/json"})
+SCOPUS_PAGE_SIZE = 25
+SCOPUS_CONCURRENCY = 6  # Scopus allows ~9 req/s per key; stay below it
+SCOPUS_RETRIES = 5
+SCOPUS_BACKOFF = 0.5
+SCOPUS_MAX_DELAY = 60
+SCOPUS_RETRY_STATUS = (429, 500, 502, 503, 504)
 
 # Your proven STANDARD field set (safe)
-FIELD = (
+FIELD: Final = (
     "eid,dc:title,dc:creator,prism:coverDate,prism:publicationName,prism:doi,"
     "prism:issn,prism:eIssn,prism:volume,prism:issueIdentifier,prism:pageRange,"
     "subtypeDescription,citedby-count,authkeywords,prism:aggregationType,prism:url,"
     "openaccess,openaccessFlag,afid,affiliation,prism:coverDisplayDate,prism:publicationDate"
 )
+_FIELD_KEYS: Final = frozenset(FIELD.split(","))
 
 STATE_FILE = "state.json"
+NOTIFIED_RETENTION_DAYS = 90
 SNAPSHOT_DIR = "snapshots"
+EMAIL_TEMPLATE = "templates/email.html"
+SMTP_RETRIES = 3
+SNAPSHOT_FIELDS = (
+    "eid", "dc:title", "dc:creator", "prism:coverDate", "prism:publicationName",
+    "prism:doi", "citedby-count", "authkeywords", "affiliation"
+)
+# Partitioned, append-only Parquet log of every paper the first time it is reported
+SNAPSHOT_SCHEMA = pa.schema([(k, pa.string()) for k in SNAPSHOT_FIELDS + ("first_seen", "year_month")])
+# Source of truth for "already notified" EIDs: eid -> first_seen (YYYY-MM-DD).
+# The leading "_" keeps pyarrow dataset discovery from reading it as snapshot rows.
+SEEN_EIDS_FILE = os.path.join(SNAPSHOT_DIR, "_seen_eids.parquet")
+_LEGACY_SEEN_EIDS_FILE = os.path.join(SNAPSHOT_DIR, "seen_eids.parquet")
+# Local LLM caches live under data/ (gitignored). They only carry over between scheduled runs
+# if the workflow persists data/ (e.g. actions/cache); otherwise they help same-machine re-runs only.
+LLM_CACHE_DIR = "data/llm_cache"
+# Several weekly cycles: keys include every EID, so a long TTL can't serve a stale corpus
+LLM_CACHE_TTL = 28 * 86400
+
+# Bump when the Gemini prompts change so cached outputs are invalidated
+PROMPT_VERSION = 4
+
+# Semantic cache: reuse a previous analysis when the metadata context is nearly identical
+# and at most ANALYSIS_MAX_EID_DIFF papers were added/removed
+ANALYSIS_RESULTS_FILE = "data/analysis_results.jsonl"
+ANALYSIS_SIM_THRESHOLD = 0.97
+ANALYSIS_MAX_EID_DIFF = 1
+ANALYSIS_RESULTS_KEEP = 52
+
+# Explicit Gemini context cache holding the static analysis instructions + LAB_CONTEXT.
+# Only pays off for a large LAB_CONTEXT: the model rejects caches below its minimum size
+# (1024-4096 tokens depending on model); a rejected config is recorded in state and not retried
+LAB_CACHE_TTL = 86400
 
 KST = ZoneInfo("Asia/Seoul")
 
@@ -51,82 +104,147 @@ KST = ZoneInfo("Asia/Seoul")
 # -----------------------------
 def load_state():
     if not os.path.exists(STATE_FILE):
-        return {"notified_eids": [], "last_report_kst": ""}
+        return {"last_report_kst": ""}
     with open(STATE_FILE, "r", encoding="utf-8") as f:
         return json.load(f)
 
 def save_state(state):
-    with open(STATE_FILE, "w", encoding="utf-8") as f:
-        json.dump(state, f, ensure_ascii=False, indent=2)
+    # Write to a temp file and swap it in, so a crash mid-write can't corrupt state.json
+    tmp = STATE_FILE + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(state, f, ensure_ascii=False, separators=(",", ":"))
+    os.replace(tmp, STATE_FILE)
+
+def load_seen_eids(legacy=None):
+    """
+    Load {eid: first_seen YYYY-MM-DD} from SEEN_EIDS_FILE, pruned to the last
+    NOTIFIED_RETENTION_DAYS. `legacy` is the old state.json notified_eids (list or dict),
+    used only when the Parquet file does not exist yet.
+    """
+    today = datetime.now(KST).date()
+    path = SEEN_EIDS_FILE if os.path.exists(SEEN_EIDS_FILE) else _LEGACY_SEEN_EIDS_FILE
+    if os.path.exists(path):
+        t = pq.read_table(path, columns=["eid", "first_seen"])
+        seen = dict(zip(t.column("eid").to_pylist(), t.column("first_seen").to_pylist()))
+    elif isinstance(legacy, list):
+        # Oldest format: flat list of EIDs without a first-seen date
+        seen = {eid: today.isoformat() for eid in legacy}
+    else:
+        seen = dict(legacy or {})
+    cutoff = (today - timedelta(days=NOTIFIED_RETENTION_DAYS)).isoformat()
+    return {eid: d for eid, d in seen.items() if d >= cutoff}
+
+def save_seen_eids(seen):
+    os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+    table = pa.table({"eid": list(seen), "first_seen": list(seen.values())},
+                     schema=pa.schema([("eid", pa.string()), ("first_seen", pa.string())]))
+    # Same temp-file + swap as save_state
+    tmp = SEEN_EIDS_FILE + ".tmp"
+    pq.write_table(table, tmp)
+    os.replace(tmp, SEEN_EIDS_FILE)
+    if os.path.exists(_LEGACY_SEEN_EIDS_FILE):
+        os.remove(_LEGACY_SEEN_EIDS_FILE)
 
 
 # -----------------------------
 # Scopus fetch
 # -----------------------------
-def scopus_search_all(query: str):
-    start, count = 0, 25
-    rows = []
-    total = None
-
-    while True:
-        params = {
-            "query": query,
-            "count": count,
-            "start": start,
-            "view": "STANDARD",
-            "field": FIELD
-        }
-        r = requests.get(SCOPUS_URL, headers=SCOPUS_HEAD, params=params, timeout=30)
-        if r.status_code != 200:
-            raise RuntimeError(f"Scopus API error {r.status_code}: {r.text[:900]}")
+_ENTRY_PREFIX = "search-results.entry.item"
+_TOTAL_PREFIX = "search-results.opensearch:totalResults"
 
-        data = r.json()
-        sr = data.get("search-results", {})
-        entries = sr.get("entry", [])
-
-        if total is None:
-            total = int(sr.get("opensearch:totalResults", 0))
-
-        if not entries:
-            break
-
-        rows.extend(entries)
-        start += count
-        if len(rows) >= total:
-            break
-
-        time.sleep(0.2)
-
-    # Dedup by EID
-    seen = set()
-    out = []
-    for e in rows:
-        eid = e.get("eid")
-        if not eid or eid in seen:
-            continue
-        seen.add(eid)
-        out.append(e)
-
-    return out
+async def _stream_page(body):
+    """
+    Stream-parse one Scopus response body, returning (total, entries).
+    Each entry is built event-by-event and projected to the FIELD keys as soon as it closes,
+    so the full response tree (links, extra metadata) is never materialized.
+    """
+    total = 0
+    entries = []
+    builder = None
+    async for prefix, event, value in ijson.parse_async(body, use_float=True):
+        if prefix == _TOTAL_PREFIX:
+            total = int(value or 0)
+        elif prefix == _ENTRY_PREFIX and event == "start_map":
+            builder = ijson.ObjectBuilder()
+
+        if builder is not None:
+            builder.event(event, value)
+            if prefix == _ENTRY_PREFIX and event == "end_map":
+                entries.append({k: v for k, v in builder.value.items() if k in _FIELD_KEYS})
+                builder = None
+    return total, entries
+
+def _quota_exhausted(r):
+    # Elsevier marks a spent weekly quota this way; waiting minutes won't help
+    return (r.headers.get("X-RateLimit-Remaining") == "0"
+            or "QUOTA_EXCEEDED" in r.headers.get("X-ELS-Status", ""))
+
+def _retry_delay(r, attempt):
+    """
+    Seconds to wait before retrying: Retry-After if given, else exponential backoff; capped.
+    X-RateLimit-Reset is deliberately ignored: Elsevier sends it on every response as the
+    weekly quota reset time, not as a short-term retry hint.
+    """
+    retry_after = r.headers.get("Retry-After", "") if r is not None else ""
+    if retry_after.isdigit():
+        return min(float(retry_after), SCOPUS_MAX_DELAY)
+    return min(SCOPUS_BACKOFF * (2 ** attempt), SCOPUS_MAX_DELAY)
+
+async def _fetch_page(session, sem, query: str, start: int):
+    params = {
+        "query": query,
+        "count": SCOPUS_PAGE_SIZE,
+        "start": start,
+        "view": "STANDARD",
+        "field": FIELD
+    }
+    for attempt in range(SCOPUS_RETRIES + 1):
+        last_attempt = attempt == SCOPUS_RETRIES
+        try:
+            async with sem:
+                async with session.get(SCOPUS_URL, params=params) as r:
+                    if r.status == 200:
+                        return await _stream_page(r.content)
+                    if (r.status not in SCOPUS_RETRY_STATUS or last_attempt
+                            or (r.status == 429 and _quota_exhausted(r))):
+                        text = await r.text()
+                        raise RuntimeError(f"Scopus API error {r.status}: {text[:900]}")
+                    delay = _retry_delay(r, attempt)
+        except (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError,
+                ijson.IncompleteJSONError, asyncio.TimeoutError) as ex:
+            if last_attempt:
+                raise
+            delay = _retry_delay(None, attempt)
+            print(f"⚠️ Scopus request failed ({type(ex).__name__}), retrying")
+        # Sleep outside the semaphore so other pages can use the slot meanwhile
+        await asyncio.sleep(delay)
+
+async def scopus_search_all_async(query: str):
+    sem = asyncio.Semaphore(SCOPUS_CONCURRENCY)
+    timeout = aiohttp.ClientTimeout(total=30)
+
+    # One pooled connector for all pages, so TLS connections are reused across requests
+    connector = aiohttp.TCPConnector(limit=8)
+
+    async with aiohttp.ClientSession(headers=SCOPUS_HEAD, timeout=timeout, connector=connector) as session:
+        # First page tells us how many results there are
+        total, rows = await _fetch_page(session, sem, query, 0)
+
+        # Remaining pages in parallel; gather preserves order
+        starts = range(SCOPUS_PAGE_SIZE, total, SCOPUS_PAGE_SIZE)
+        pages = await asyncio.gather(*[_fetch_page(session, sem, query, s) for s in starts])
+        for _, entries in pages:
+            rows.extend(entries)
+
+    # Dedup by EID (dict keeps first-seen order)
+    return list({e["eid"]: e for e in rows if e.get("eid")}.values())
 
 
 # -----------------------------
-# Link helpers (human-friendly)
+# Affiliation helpers (human-friendly)
 # -----------------------------
-def paper_links(e):
-    eid = (e.get("eid", "") or "").strip()
-    doi = (e.get("prism:doi", "") or "").strip()
-
-    doi_link = f"https://doi.org/{doi}" if doi else ""
-    scopus_web = f"https://www.scopus.com/record/display.uri?eid={eid}&origin=resultslist" if eid else ""
-    return doi_link, scopus_web
-
-def format_affiliation(aff):
-    """
-    Convert Scopus 'affiliation' field (string / dict / list[dict]) into clean text.
-    Example:
-      Guangxi University (Nanning, China); Ningbo Institute ... (Ningbo, China)
-    """
+def _format_affiliation_slow(aff):
+    """General dispatch for format_affiliation (str / dict / mixed lists)."""
     if not aff:
         return ""
 
@@ -150,18 +268,13 @@ def format_affiliation(aff):
     if isinstance(aff, list):
         parts = [one(a) for a in aff if a]
         # de-dup while preserving order
-        seen = set()
-        cleaned = []
-        for p in parts:
-            if p and p not in seen:
-                seen.add(p)
-                cleaned.append(p)
+        cleaned = list(dict.fromkeys(p for p in parts if p))
         return "; ".join(cleaned)
 
     return str(aff)
 
-def format_affiliation_one(aff):
-    """Return only ONE affiliation in a clean form."""
+def _format_affiliation_one_slow(aff):
+    """General dispatch for format_affiliation_one (str / dict / mixed lists)."""
     if not aff:
         return ""
     if isinstance(aff, str):
@@ -182,90 +295,252 @@ def format_affiliation_one(aff):
         return one(aff[0])
     return str(aff)
 
+def format_affiliation(aff):
+    """
+    Convert Scopus 'affiliation' field (string / dict / list[dict]) into clean text.
+    Example:
+      Guangxi University (Nanning, China); Ningbo Institute ... (Ningbo, China)
+    """
+    # Fast path: Scopus almost always returns a short list[dict]
+    if type(aff) is list and aff and all(type(a) is dict for a in aff):
+        parts = []
+        for a in aff:
+            name = a.get("affilname") or a.get("affiliation-name") or ""
+            city = a.get("affiliation-city") or ""
+            country = a.get("affiliation-country") or ""
+            loc = f"{city}, {country}" if city and country else city or country
+            parts.append(f"{name} ({loc})" if name and loc else name or loc)
+        # de-dup while preserving order
+        return "; ".join(dict.fromkeys(p for p in parts if p))
+    return _format_affiliation_slow(aff)
+
+def format_affiliation_one(aff):
+    """Return only ONE affiliation in a clean form."""
+    # Fast path: Scopus almost always returns a short list[dict]
+    if type(aff) is list and aff and type(aff[0]) is dict:
+        a = aff[0]
+        name = a.get("affilname") or ""
+        city = a.get("affiliation-city") or ""
+        country = a.get("affiliation-country") or ""
+        loc = f"{city}, {country}" if city and country else city or country
+        return f"{name} ({loc})" if loc else name
+    return _format_affiliation_one_slow(aff)
+
+# -----------------------------
+# Paper projection (one pass over the raw Scopus dicts)
+# -----------------------------
+@dataclass(slots=True)
+class Paper:
+    eid: str
+    title: str
+    author: str
+    doi: str
+    journal: str
+    cover: str
+    cited: str
+    aff: str
+    keywords: str
+    doi_link: str
+    scopus_web: str
+
+def to_paper(e):
+    """Project a raw Scopus entry into a Paper with all strings (and links) computed once."""
+    eid = (e.get("eid", "") or "").strip()
+    doi = (e.get("prism:doi", "") or "").strip()
+    return Paper(
+        eid=eid,
+        title=e.get("dc:title", "") or "",
+        author=e.get("dc:creator", "") or "",
+        doi=doi,
+        journal=e.get("prism:publicationName", "") or "",
+        cover=e.get("prism:coverDate", "") or "",
+        cited=str(e.get("citedby-count", "") or ""),
+        aff=format_affiliation_one(e.get("affiliation", "")),
+        keywords=e.get("authkeywords", "") or "",
+        doi_link=f"https://doi.org/{doi}" if doi else "",
+        scopus_web=f"https://www.scopus.com/record/display.uri?eid={eid}&origin=resultslist" if eid else "",
+    )
+
 # -----------------------------
 # Gemini: trend + directions
 # -----------------------------
-def gemini_client():
-    if not GEMINI_API_KEY:
+_llm_cache = None
+_MISS = object()
+
+def _get_llm_cache():
+    # Opened on first use so runs without GEMINI_API_KEY never touch data/llm_cache
+    global _llm_cache
+    if _llm_cache is None:
+        _llm_cache = Cache(LLM_CACHE_DIR)
+    return _llm_cache
+
+class GeminiAPIError(RuntimeError):
+    def __init__(self, status, text):
+        super().__init__(f"Gemini API error {status}: {text[:900]}")
+        self.status = status
+
+def _gemini_post(path, payload, timeout=60):
+    # Key goes in a header, not the URL, so it never shows up in logged errors
+    r = httpx.post(
+        f"{GEMINI_API_BASE}/{path}",
+        headers={"x-goog-api-key": GEMINI_API_KEY},
+        json=payload,
+        timeout=timeout,
+    )
+    if r.status_code != 200:
+        raise GeminiAPIError(r.status_code, r.text)
+    return r.json()
+
+def _user_content(text):
+    return {"role": "user", "parts": [{"text": text}]}
+
+def _gemini_generate(prompt, label, cached_content="", response_schema=None):
+    """POST :generateContent and return the response text (usage is logged under label)."""
+    payload = {"contents": [_user_content(prompt)]}
+    if cached_content:
+        payload["cachedContent"] = cached_content
+    if response_schema:
+        payload["generationConfig"] = {
+            "responseMimeType": "application/json",
+            "responseSchema": response_schema,
+        }
+    data = _gemini_post(f"models/{GEMINI_MODEL}:generateContent", payload)
+    _log_usage(label, data.get("usageMetadata"))
+    parts = data["candidates"][0]["content"]["parts"]
+    return "".join(part.get("text", "") for part in parts).strip()
+
+def _cached_generate(key_tuple, fn, complete=bool, force=False):
+    """
+    Return a cached Gemini result for identical inputs, else call fn() and store it.
+    Only results for which complete(result) is true are stored. force skips the lookup
+    (but still refreshes the stored entry).
+    """
+    k = hashlib.sha256(json.dumps(key_tuple, sort_keys=True, ensure_ascii=False).encode()).hexdigest()
+    cache = _get_llm_cache()
+    # Single get() instead of `in` + [] so an entry expiring in between can't raise KeyError
+    hit = _MISS if force else cache.get(k, default=_MISS)
+    if hit is not _MISS:
+        print("LLM cache hit:", key_tuple[0])
+        return hit
+    result = fn()
+    # Failures (empty or partial) should be retried next run
+    if complete(result):
+        cache.set(k, result, expire=LLM_CACHE_TTL)
+    return result
+
+def _embed(text):
+    """Unit-normalized Gemini embedding of text, or None if embedding fails."""
+    try:
+        data = _gemini_post(
+            f"models/{GEMINI_EMBED_MODEL}:embedContent",
+            {"model": f"models/{GEMINI_EMBED_MODEL}", "content": {"parts": [{"text": text}]}},
+        )
+        vec = data["embedding"]["values"]
+    except Exception as ex:
+        print("⚠️ Gemini embedding failed:", str(ex)[:300])
         return None
-    return genai.Client(api_key=GEMINI_API_KEY)
+    norm = sum(x * x for x in vec) ** 0.5
+    return [x / norm for x in vec] if norm else None
+
+def _load_analysis_results():
+    if not os.path.exists(ANALYSIS_RESULTS_FILE):
+        return []
+    with open(ANALYSIS_RESULTS_FILE, "r", encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def _semantic_candidates(scope, eids):
+    """Stored rows for the same scope whose EID set differs by at most ANALYSIS_MAX_EID_DIFF papers."""
+    return [row for row in _load_analysis_results()
+            if row.get("scope") == scope
+            and len(eids ^ set(row.get("eids", ()))) <= ANALYSIS_MAX_EID_DIFF]
+
+def _semantic_lookup(context, candidates):
+    """
+    Return the candidate result whose context embedding is most similar to context's, if above
+    threshold. Embeddings are only requested here, i.e. when the EID filter left something.
+    """
+    emb = _embed(context)
+    if not emb:
+        return None
+    best_sim, best = 0.0, None
+    for row in candidates:
+        row_emb = row.get("emb") or _embed(row.get("context", ""))
+        if not row_emb or len(row_emb) != len(emb):
+            continue
+        # Both vectors are unit-normalized, so the dot product is the cosine similarity
+        sim = sum(a * b for a, b in zip(emb, row_emb))
+        if sim > best_sim:
+            best_sim, best = sim, row.get("result")
+    if best and best_sim >= ANALYSIS_SIM_THRESHOLD:
+        print(f"Semantic cache hit (cosine={best_sim:.4f})")
+        return best
+    return None
+
+def _semantic_store(scope, eids, context, result):
+    # The context is stored instead of its embedding; it is only embedded if it ever becomes a candidate
+    rows = _load_analysis_results()
+    rows.append({"scope": scope, "eids": sorted(eids), "context": context, "result": result})
+    rows = rows[-ANALYSIS_RESULTS_KEEP:]
+    os.makedirs(os.path.dirname(ANALYSIS_RESULTS_FILE), exist_ok=True)
+    tmp = ANALYSIS_RESULTS_FILE + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        for row in rows:
+            f.write(json.dumps(row, ensure_ascii=False) + "\n")
+    os.replace(tmp, ANALYSIS_RESULTS_FILE)
+
+def _cited(p):
+    try:
+        return int(p.cited or 0)
+    except (TypeError, ValueError):
+        return 0
 
-def build_metadata_context(entries, cap=50):
+def build_metadata_context(papers, cap=50, title_len=140, kw_len=200):
+    """
+    Compact metadata block for Gemini: highest-cited entries first, duplicate titles and
+    entries whose keywords are already covered by an included entry are skipped.
+    """
     lines = []
-    for e in entries[:cap]:
-        title = e.get("dc:title", "")
-        author = e.get("dc:creator", "")
-        aff = format_affiliation_one(e.get("affiliation", ""))
-        kw = e.get("authkeywords", "")
-        journal = e.get("prism:publicationName", "")
-        cover = e.get("prism:coverDate", "")
-        lines.append(
-            f"- Title: {title}\n"
-            f"  Author: {author}\n"
-            f"  Affiliation: {aff}\n"
-            f"  Journal: {journal}\n"
-            f"  CoverDate: {cover}\n"
-            f"  Keywords: {kw}"
+    seen_titles = set()
+    kw_sets = []
+    for p in sorted(papers, key=_cited, reverse=True):
+        if len(lines) >= cap:
+            break
+        title = p.title
+        norm = re.sub(r"\W+", "", title.lower())
+        if norm and norm in seen_titles:
+            continue
+        kw = p.keywords
+        kws = {k.strip().lower() for k in kw.split("|") if k.strip()}
+        if kws and any(kws <= prev for prev in kw_sets):
+            continue
+        seen_titles.add(norm)
+        if kws:
+            kw_sets.append(kws)
+
+        block = f"- Title: {title[:title_len]}\n"
+        if p.author:
+            block += f"  Author: {p.author}\n"
+        block += (
+            f"  Affiliation: {p.aff}\n"
+            f"  Journal: {p.journal}\n"
+            f"  CoverDate: {p.cover}\n"
+            f"  Keywords: {kw[:kw_len]}"
         )
+        lines.append(block)
     return "\n".join(lines)
 
-def generate_trend_summary(entries_30d, language="ko"):
-    client = gemini_client()
-    if client is None or not entries_30d:
-        return ""
-
-    context = build_metadata_context(entries_30d, cap=60)
-
-    if language.lower().startswith("ko"):
-        prompt = f"""
-너는 적층제조(AM) 및 초내열합금(superalloys) 분야의 연구 동향 분석가다.
-아래 메타데이터(제목/키워드/저자/소속/저널)만 근거로, 지난 30일 신규 유입 논문에 대한 '한 문단(5~7문장)' 동향 요약을 작성해라.
+ANALYSIS_INSTRUCTIONS_KO = """
+너는 적층제조(AM) 및 초내열합금(superalloys) 분야의 연구 동향 분석가이자 시니어 연구기획자다.
+함께 제공되는 '우리 연구실 환경'과 '지난 30일 신규 유입 논문 메타데이터'(제목/키워드/저자/소속/저널)만 근거로 아래 두 가지를 작성해라.
 
+[trend] 지난 30일 신규 유입 논문에 대한 '한 문단(5~7문장)' 동향 요약
 필수 포함:
 - 반복적으로 등장하는 핵심 주제/문제(예: cracking, microstructure, creep 등)
 - 공정/소재 관점의 흐름(가능한 범위 내)
 - 소속기관/국가의 특징이 보이면 언급(불확실하면 "근거 부족"이라고 표시)
 - 과장 금지, 근거 없는 사실 생성 금지
 
-메타데이터:
-{context}
-"""
-    else:
-        prompt = f"""
-Write ONE paragraph (5–7 sentences) trend summary based ONLY on the metadata below.
-Include recurring themes, materials/process trends, and notable institutions/countries if clearly supported.
-Do not invent facts.
-
-Metadata:
-{context}
-"""
-
-    try:
-        resp = client.models.generate_content(model=GEMINI_MODEL, contents=prompt)
-        return (resp.text or "").strip()
-    except Exception as ex:
-        print("⚠️ Gemini trend summary failed:", str(ex)[:300])
-        return ""
-
-def generate_research_directions(entries_30d, lab_context, language="ko"):
-    client = gemini_client()
-    if client is None or not entries_30d:
-        return ""
-
-    context = build_metadata_context(entries_30d, cap=60)
-
-    # If lab_context is missing, still produce general directions but label it
-    lab_block = lab_context if lab_context else "(Lab context not provided. Provide feasible directions with common AM/superalloy lab capabilities.)"
-
-    if language.lower().startswith("ko"):
-        prompt = f"""
-너는 소재/제조 분야(특히 AM 및 초내열합금) 시니어 연구기획자다.
-아래 '지난 30일 신규 유입 논문 메타데이터'를 검토하고, '우리 연구실 환경'에 맞는 새로운 연구 방향 5개를 제시해라.
-
-[우리 연구실 환경 / 제약조건]
-{lab_block}
-
-[출력 형식]
+[directions] 우리 연구실 환경에 맞는 새로운 연구 방향 5개
 각 연구 방향마다 반드시 포함:
 1) 연구 방향 제목(12단어 이내)
 2) 근거(메타데이터에서 관찰되는 반복 키워드/주제/기관 분포 등)
@@ -278,16 +553,17 @@ def generate_research_directions(entries_30d, lab_context, language="ko"):
 - 메타데이터로부터 확인 불가능한 사실은 만들지 말고 "근거 부족"이라고 명시해라.
 - 논문을 하나씩 나열하지 말고 종합적으로 제안하라.
 
-[논문 메타데이터]
-{context}
+[응답 형식]
+반드시 JSON 객체 하나로만 응답해라: {"trend": "...", "directions": "..."}
 """
-    else:
-        prompt = f"""
-Propose 5 research directions tailored to the lab context below, based ONLY on the last-30-days paper metadata.
 
-Lab context:
-{lab_block}
+ANALYSIS_INSTRUCTIONS_EN = """
+Based ONLY on the provided lab context and last-30-days paper metadata, write two things.
+
+[trend] ONE paragraph (5–7 sentences) trend summary.
+Include recurring themes, materials/process trends, and notable institutions/countries if clearly supported.
 
+[directions] 5 research directions tailored to the lab context.
 For each direction include:
 - Title (<= 12 words)
 - Rationale grounded in metadata
@@ -298,21 +574,156 @@ For each direction include:
 
 Do not invent facts not supported by metadata.
 
-Metadata:
-{context}
+Respond ONLY as JSON: {"trend": "...", "directions": "..."}
 """
 
+# REST (OpenAPI subset) schema, hence the upper-case type names
+ANALYSIS_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {
+        "trend": {"type": "STRING"},
+        "directions": {"type": "STRING"},
+    },
+    "required": ["trend", "directions"],
+}
+
+def _analysis_prompt_parts(lab_context, language):
+    """
+    Split the analysis prompt into (static instructions, lab block, metadata header).
+    Order matters for prefix caching: static -> rarely-changing lab context -> weekly metadata.
+    """
+    # If lab_context is missing, still produce general directions but label it
+    lab_block = lab_context if lab_context else "(Lab context not provided. Provide feasible directions with common AM/superalloy lab capabilities.)"
+
+    if language.lower().startswith("ko"):
+        return ANALYSIS_INSTRUCTIONS_KO, f"[우리 연구실 환경 / 제약조건]\n{lab_block}\n", "[논문 메타데이터]"
+    return ANALYSIS_INSTRUCTIONS_EN, f"Lab context:\n{lab_block}\n", "Metadata:"
+
+def _log_usage(label, usage):
+    if not usage:
+        return
+    print(f"Gemini {label} tokens: prompt={usage.get('promptTokenCount', 0)} "
+          f"cached={usage.get('cachedContentTokenCount', 0)}")
+
+def ensure_lab_cache(state, lab_context, language="ko"):
+    """
+    Return the name of an explicit Gemini cache holding the analysis instructions + lab context.
+    The cache name is persisted in state and reused while it is still alive and the inputs match.
+    Returns "" when caching is unavailable (no key, content below the model's minimum size, ...).
+    A create rejected with 400 is remembered per input key, so it is attempted once, not every run.
+    """
+    if not GEMINI_API_KEY:
+        return ""
+
+    instructions, lab_part, _ = _analysis_prompt_parts(lab_context, language)
+    key = hashlib.sha256(
+        json.dumps([GEMINI_MODEL, PROMPT_VERSION, instructions, lab_part], ensure_ascii=False).encode()
+    ).hexdigest()
+
+    now = datetime.now(timezone.utc)
+    cached = state.get("gemini_lab_cache") or {}
+    if cached.get("key") == key:
+        if cached.get("rejected"):
+            return ""
+        if cached.get("expire_time", "") > now.isoformat():
+            return cached["name"]
+
     try:
-        resp = client.models.generate_content(model=GEMINI_MODEL, contents=prompt)
-        return (resp.text or "").strip()
+        cache = _gemini_post("cachedContents", {
+            "model": f"models/{GEMINI_MODEL}",
+            "systemInstruction": {"parts": [{"text": instructions}]},
+            "contents": [_user_content(lab_part)],
+            "ttl": f"{LAB_CACHE_TTL}s",
+        })
     except Exception as ex:
-        print("⚠️ Gemini research directions failed:", str(ex)[:300])
+        print("⚠️ Gemini context cache unavailable:", str(ex)[:300])
+        # 400 = rejected for this content (e.g. too small); other errors may be transient
+        if getattr(ex, "status", None) == 400:
+            state["gemini_lab_cache"] = {"key": key, "rejected": True}
         return ""
 
+    # Keep a small margin so we never hand out a cache that expires mid-run
+    expire = now + timedelta(seconds=LAB_CACHE_TTL - 300)
+    state["gemini_lab_cache"] = {"name": cache["name"], "key": key, "expire_time": expire.isoformat()}
+    return cache["name"]
+
+def _parse_analysis(text):
+    data = json.loads(text or "{}")
+    return {
+        "trend": (data.get("trend") or "").strip(),
+        "directions": (data.get("directions") or "").strip(),
+    }
+
+def analysis_config_key(lab_context, language="ko"):
+    """Hash of everything besides the papers that shapes the analysis (model, prompt, lab)."""
+    return hashlib.sha256(
+        json.dumps([GEMINI_MODEL, language, PROMPT_VERSION, lab_context], ensure_ascii=False).encode()
+    ).hexdigest()
+
+def _analysis_complete(result):
+    return bool(result.get("trend") and result.get("directions"))
+
+def generate_trend_and_directions(papers, lab_context, language="ko", state=None, force=False):
+    """
+    One Gemini call for both the 30-day trend summary and the lab-tailored research directions,
+    so the metadata block is only sent once. Returns (trend_summary, directions_text).
+    If state is given, the explicit lab-context cache is created/reused (and recorded there),
+    but only once the local caches have missed and Gemini is actually about to be called.
+    force bypasses the exact-hash and semantic caches (results are still stored).
+    """
+    if not GEMINI_API_KEY or not papers:
+        return "", ""
+
+    context = build_metadata_context(papers, cap=60)
+    instructions, lab_part, meta_header = _analysis_prompt_parts(lab_context, language)
+    metadata_part = f"{meta_header}\n{context}\n"
+
+    scope = [GEMINI_MODEL, GEMINI_EMBED_MODEL, language, PROMPT_VERSION,
+             hashlib.sha256(lab_part.encode()).hexdigest()]
+
+    def generate():
+        cache_name = ensure_lab_cache(state, lab_context, language) if state is not None else ""
+        if cache_name:
+            try:
+                text = _gemini_generate(metadata_part, "analysis", cached_content=cache_name,
+                                        response_schema=ANALYSIS_SCHEMA)
+                return _parse_analysis(text)
+            except Exception as ex:
+                print("⚠️ Gemini cached analysis failed, retrying without cache:", str(ex)[:300])
+        try:
+            text = _gemini_generate(f"{instructions}\n{lab_part}\n{metadata_part}", "analysis",
+                                    response_schema=ANALYSIS_SCHEMA)
+            return _parse_analysis(text)
+        except Exception as ex:
+            print("⚠️ Gemini trend/directions analysis failed:", str(ex)[:300])
+            return {}
+
+    eids = {p.eid for p in papers}
+
+    def call():
+        if not force:
+            candidates = _semantic_candidates(scope, eids)
+            hit = _semantic_lookup(context, candidates) if candidates else None
+            if hit:
+                return hit
+        result = generate()
+        if _analysis_complete(result):
+            _semantic_store(scope, eids, context, result)
+        return result
+
+    key = ("analysis", GEMINI_MODEL, language, PROMPT_VERSION, lab_context,
+           sorted(p.eid for p in papers))
+    result = _cached_generate(key, call, complete=_analysis_complete, force=force)
+    return result.get("trend", ""), result.get("directions", "")
+
 
 # -----------------------------
 # Email
 # -----------------------------
+# Parsed/compiled once per process
+with open(EMAIL_TEMPLATE, "r", encoding="utf-8") as _f:
+    _EMAIL_TMPL = jinja2.Environment(autoescape=True).from_string(_f.read())
+
 def send_email(subject, html_body):
     to_list = [x.strip() for x in EMAIL_TO.split(",") if x.strip()]
     msg = MIMEMultipart("alternative")
@@ -321,98 +732,91 @@ def send_email(subject, html_body):
     msg["Subject"] = subject
     msg.attach(MIMEText(html_body, "html"))
 
-    with smtplib.SMTP_SSL("smtp.gmail.com", 465) as server:
-        server.login(EMAIL_FROM, GMAIL_APP_PASSWORD)
-        server.sendmail(EMAIL_FROM, to_list, msg.as_string())
-
-
-def save_snapshot(entries, label):
-    os.makedirs(SNAPSHOT_DIR, exist_ok=True)
-    pd.DataFrame(entries).to_csv(os.path.join(SNAPSHOT_DIR, f"{label}.csv"), index=False)
+    send_messages([(to_list, msg)])
 
+def _smtp_transient(ex):
+    """True for errors worth retrying: dropped connections and 4xx replies. 5xx is permanent."""
+    if isinstance(ex, smtplib.SMTPServerDisconnected):
+        return True
+    if isinstance(ex, smtplib.SMTPRecipientsRefused):
+        return all(400 <= code < 500 for code, _ in ex.recipients.values())
+    if isinstance(ex, smtplib.SMTPResponseException):
+        return 400 <= ex.smtp_code < 500
+    # Plain socket/TLS errors are transient; any other SMTPException is not
+    return not isinstance(ex, smtplib.SMTPException)
 
-def build_email_html(entries_30d, cutoff_yyyymmdd, trend_summary, directions_text, new_since_last):
-    # Sort newest coverDate first
-    def parse_date(x):
+def send_messages(messages):
+    """
+    Send [(to_list, msg), ...] over a single authenticated SMTP connection, so TLS + login
+    is paid once however many messages there are. Transient SMTP failures are retried with
+    exponential backoff; messages already sent are not re-sent.
+    """
+    pending = list(messages)
+    for attempt in range(SMTP_RETRIES):
         try:
-            return pd.to_datetime(x.get("prism:coverDate", None))
-        except Exception:
-            return pd.NaT
-    entries_30d = sorted(entries_30d, key=parse_date, reverse=True)
-
-    trend_html = ""
-    if trend_summary:
-        trend_html = f"""
-        <div style="padding:12px;border:1px solid #ddd;border-radius:8px;background:#fafafa;margin:12px 0;">
-          <b>30-Day Trend Summary</b><br/>
-          <span>{trend_summary}</span>
-        </div>
-        """
-
-    directions_html = ""
-    if directions_text:
-        directions_html = f"""
-        <div style="padding:12px;border:1px solid #ddd;border-radius:8px;background:#f6fbff;margin:12px 0;">
-          <b>New Research Directions (Lab-Tailored)</b><br/>
-          <span style="white-space:pre-wrap;">{directions_text}</span>
-        </div>
-        """
-
-    new_block = ""
-    if new_since_last:
-        new_block = f"<p><b>New since last weekly report:</b> {len(new_since_last)} papers</p>"
-
-    items = []
-    for e in entries_30d[:40]:
-        title = e.get("dc:title", "(no title)")
-        journal = e.get("prism:publicationName", "")
-        cover = e.get("prism:coverDate", "")
-        doi = (e.get("prism:doi", "") or "").strip()
-        author = e.get("dc:creator", "")
-        aff = format_affiliation_one(e.get("affiliation", ""))
-        cited = e.get("citedby-count", "")
-
-        doi_link, scopus_web = paper_links(e)
-
-        links = []
-        if doi_link:
-            links.append(f'<a href="{doi_link}">DOI</a>')
-        if scopus_web:
-            links.append(f'<a href="{scopus_web}">Scopus</a>')
-        link_html = " | ".join(links) if links else ""
-
-        items.append(f"""
-        <li style="margin-bottom:14px;">
-          <b>{title}</b><br/>
-          <span>{journal} | {cover} | cited-by: {cited}</span><br/>
-          <span>Author: {author}</span><br/>
-          <span>Affiliation: {aff}</span><br/>
-          <span>DOI: {doi}</span><br/>
-          {link_html}
-        </li>
-        """)
-
-    html = f"""
-    <html>
-    <body style="font-family: Arial, sans-serif;">
-      <h2>🧭 Weekly Scopus Monitor (Last 30 Days)</h2>
-      <p>Filter: <b>({QUERY_CORE}) AND ORIG-LOAD-DATE AFT {cutoff_yyyymmdd}</b></p>
-      {new_block}
-      {trend_html}
-      {directions_html}
-
-      <hr/>
-      <p><b>Papers (top 40 by latest coverDate)</b></p>
-      <ol>
-        {''.join(items)}
-      </ol>
-
-      <hr/>
-      <p style="color:#777;font-size:12px;">Auto-generated weekly report.</p>
-    </body>
-    </html>
+            with smtplib.SMTP_SSL("smtp.gmail.com", 465) as server:
+                server.login(EMAIL_FROM, GMAIL_APP_PASSWORD)
+                while pending:
+                    to_list, msg = pending[0]
+                    server.sendmail(EMAIL_FROM, to_list, msg.as_string())
+                    pending.pop(0)
+            return
+        except OSError as ex:  # smtplib.SMTPException is an OSError too
+            if not _smtp_transient(ex) or attempt == SMTP_RETRIES - 1:
+                raise
+            print(f"⚠️ SMTP send failed ({str(ex)[:200]}), retrying")
+            time.sleep(2 ** attempt)
+
+
+def save_snapshot(new_entries, seen_date):
+    """
+    Append only the papers first seen this run to the Parquet dataset under SNAPSHOT_DIR,
+    partitioned by year_month. Every write gets its own file, so runs never replace each other.
     """
-    return html
+    if not new_entries:
+        return
+    rows = []
+    for e in new_entries:
+        row = {k: str(e.get(k) or "") for k in SNAPSHOT_FIELDS}
+        # Nested affiliation lists are flattened to text
+        row["affiliation"] = format_affiliation(e.get("affiliation"))
+        row["first_seen"] = seen_date
+        row["year_month"] = seen_date[:7]
+        rows.append(row)
+    pq.write_to_dataset(
+        pa.Table.from_pylist(rows, schema=SNAPSHOT_SCHEMA),
+        root_path=SNAPSHOT_DIR,
+        partition_cols=["year_month"],
+        basename_template=f"weekly_{seen_date}_{uuid.uuid4().hex}_{{i}}.parquet",
+        existing_data_behavior="overwrite_or_ignore",
+    )
+
+def read_snapshots(columns=("dc:title", "authkeywords", "prism:coverDate")):
+    """
+    Read back the snapshot log with column projection (skips e.g. the affiliation text).
+    Only the year_month=* partitions are read, so older CSV snapshots in SNAPSHOT_DIR are ignored.
+    """
+    files = sorted(glob.glob(os.path.join(SNAPSHOT_DIR, "year_month=*", "*.parquet")))
+    if not files:
+        return SNAPSHOT_SCHEMA.empty_table().select(list(columns))
+    dataset = ds.dataset(files, schema=SNAPSHOT_SCHEMA, format="parquet",
+                         partitioning="hive", partition_base_dir=SNAPSHOT_DIR)
+    return dataset.to_table(columns=list(columns))
+
+
+def build_email_html(papers, cutoff_yyyymmdd, trend_summary, directions_text, new_since_last):
+    # Sort newest coverDate first (YYYY-MM-DD sorts chronologically as a string)
+    papers = sorted(papers, key=lambda p: p.cover, reverse=True)
+
+    # Autoescaping covers titles/affiliations with <, > or & as well as Gemini output
+    return _EMAIL_TMPL.render(
+        query=QUERY_CORE,
+        cutoff=cutoff_yyyymmdd,
+        trend=trend_summary,
+        directions=directions_text,
+        new_count=len(new_since_last),
+        papers=papers[:40],
+    )
 
 
 # -----------------------------
@@ -427,43 +831,61 @@ def main():
     print("Query:", query)
 
     state = load_state()
-    notified = set(state.get("notified_eids", []))
+    notified = load_seen_eids(state.pop("notified_eids", None))
 
-    entries_30d = scopus_search_all(query)
+    entries_30d = asyncio.run(scopus_search_all_async(query))
     print("Fetched entries (30d):", len(entries_30d))
+    papers = [to_paper(e) for e in entries_30d]
 
-    # For "new since last report" info
-    new_since_last = [e for e in entries_30d if e.get("eid") and e["eid"] not in notified]
+    # One pass: collect "new since last report" and record every EID with its first-seen date
+    seen_date = kst_now.date().isoformat()
+    new_since_last = []
+    for e in entries_30d:
+        eid = e.get("eid")
+        if not eid:
+            continue
+        if eid not in notified:
+            new_since_last.append(e)
+            notified[eid] = seen_date
 
-    # Save snapshots
     today_kst = kst_now.strftime("%Y%m%d")
-    save_snapshot(entries_30d, f"weekly_scopus_all_30d_{today_kst}")
-    save_snapshot(new_since_last, f"weekly_scopus_new_since_last_{today_kst}")
 
     # Gemini analysis
     print("GEMINI_API_KEY present:", bool(GEMINI_API_KEY))
     print("GEMINI_MODEL:", GEMINI_MODEL)
 
-    trend_summary = generate_trend_summary(entries_30d, language="ko")
-    directions_text = generate_research_directions(entries_30d, LAB_CONTEXT, language="ko")
+    # Nothing new since last week -> reuse last week's analysis instead of re-asking Gemini
+    regen = FORCE_REGEN or bool(new_since_last)
+    print("Regenerate Gemini analysis:", regen)
+
+    # Reuse only output produced by the same model/prompt/lab context, and never for an empty report
+    config_key = analysis_config_key(LAB_CONTEXT, language="ko")
+    reuse = bool(papers) and not regen and state.get("last_analysis_key") == config_key
+    trend_summary = state.get("last_trend_summary", "") if reuse else ""
+    directions_text = state.get("last_directions_text", "") if reuse else ""
+    if not trend_summary or not directions_text:
+        trend_summary, directions_text = generate_trend_and_directions(
+            papers, LAB_CONTEXT, language="ko", state=state, force=FORCE_REGEN
+        )
 
     print("trend_summary length:", len(trend_summary))
     print("directions_text length:", len(directions_text))
 
 
     subject = f"[Weekly Scopus] 30-day trends + directions ({today_kst})"
-    html = build_email_html(entries_30d, cutoff, trend_summary, directions_text, new_since_last)
+    html = build_email_html(papers, cutoff, trend_summary, directions_text, new_since_last)
 
     send_email(subject, html)
     print("✅ Weekly email sent.")
 
-    # Update state (store all EIDs seen in this report)
-    for e in entries_30d:
-        eid = e.get("eid")
-        if eid:
-            notified.add(eid)
+    # Persist only after the email went out, so a failed send is retried next run
+    save_snapshot(new_since_last, seen_date)
+    save_seen_eids(notified)
 
-    state["notified_eids"] = sorted(list(notified))
+    if trend_summary and directions_text:
+        state["last_trend_summary"] = trend_summary
+        state["last_directions_text"] = directions_text
+        state["last_analysis_key"] = config_key
     state["last_report_kst"] = kst_now.strftime("%Y-%m-%d %H:%M:%S %Z")
     save_state(state)
     print("✅ State updated.")